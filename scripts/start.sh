@@ -3,18 +3,446 @@
 # RTSP server details
 RTSP_URL="rtsp://mediamtx:8554/live"
 
+# Host and port of the RTSP server, for the reachability check. Any
+# user:password@ is dropped, and the port defaults to 554 like RTSP itself.
+RTSP_HOST="${RTSP_URL#*://}"
+RTSP_HOST="${RTSP_HOST%%/*}"
+RTSP_HOST="${RTSP_HOST##*@}"
+RTSP_PORT=554
+if [[ "$RTSP_HOST" =~ :([0-9]+)$ ]]; then
+  RTSP_PORT="${BASH_REMATCH[1]}"
+  RTSP_HOST="${RTSP_HOST%:*}"
+fi
+RTSP_HOST="${RTSP_HOST#\[}"  # IPv6 literals are bracketed in URLs
+RTSP_HOST="${RTSP_HOST%\]}"
+
 # Directory containing videos
 VIDEOS_DIR="/videos"
 
-# Loop through all files in the videos directory
+# Exit with an error unless the named setting is a positive integer
+require_positive_integer() {
+  local name="$1"
+  if [[ ! "${!name}" =~ ^[1-9][0-9]*$ ]]; then
+    echo "$name must be a positive integer, got '${!name}'" >&2
+    exit 1
+  fi
+}
+
+# Restarts back off exponentially (1s, 2s, 4s, ...) up to this many seconds.
+# A stream that keeps failing is then retried at this interval for as long
+# as its file exists.
+MAX_RESTART_DELAY=300
+
+# A stream that ran at least this many seconds counts as healthy again:
+# its backoff and restart count start over
+HEALTHY_RUNTIME=60
+
+# Seconds to wait before restarting a stream while the RTSP server is
+# unreachable. These waits do not grow the restart backoff.
+UNREACHABLE_DELAY=30
+
+# Seconds streams get to exit after SIGTERM before they are killed. Keep
+# this below the Docker stop timeout (10s by default).
+STOP_TIMEOUT=5
+
+# Estimated memory used by one stream, in MiB. Only as many streams as fit
+# into the available memory are run at once; the rest wait for a free slot.
+STREAM_MEMORY_MB="${STREAM_MEMORY_MB:-300}"
+require_positive_integer STREAM_MEMORY_MB
+
+# Maximum number of concurrent streams. Derived from STREAM_MEMORY_MB and
+# the memory available at startup when unset.
+MAX_STREAMS="${MAX_STREAMS:-}"
+if [[ -n "$MAX_STREAMS" ]]; then
+  require_positive_integer MAX_STREAMS
+fi
+
+# Set to 1 to log the full ffmpeg command line of every start
+DEBUG="${DEBUG:-0}"
+if [[ "$DEBUG" != 0 && "$DEBUG" != 1 ]]; then
+  echo "DEBUG must be 0 or 1, got '$DEBUG'" >&2
+  exit 1
+fi
+
+# Video encoder: cpu (libx264), nvenc, qsv or vaapi. Hardware encoders
+# need an FFmpeg image and container built with access to the GPU.
+VIDEO_ENCODER="${VIDEO_ENCODER:-cpu}"
+VIDEO_ENCODER="${VIDEO_ENCODER,,}"
+
+# Number of encoder sessions the GPU supports at once (NVENC on consumer
+# cards is limited). Caps MAX_STREAMS when a hardware encoder is used.
+MAX_ENCODER_SESSIONS="${MAX_ENCODER_SESSIONS:-}"
+if [[ -n "$MAX_ENCODER_SESSIONS" ]]; then
+  require_positive_integer MAX_ENCODER_SESSIONS
+fi
+
+# Number of streams launched per second when many start at once, so the
+# host is not hit by all ffmpeg start-ups together. Defaults to the number
+# of CPUs, at most 8.
+LAUNCH_BATCH="${LAUNCH_BATCH:-}"
+if [[ -z "$LAUNCH_BATCH" ]]; then
+  LAUNCH_BATCH=$(nproc 2>/dev/null || echo 1)
+  if (( LAUNCH_BATCH > 8 )); then
+    LAUNCH_BATCH=8
+  fi
+fi
+require_positive_integer LAUNCH_BATCH
+
+# File extensions that are picked up as videos, space-separated
+VIDEO_EXTENSIONS="${VIDEO_EXTENSIONS:-mp4 m4v mkv mov avi wmv webm flv ts m2ts mts mpg mpeg 3gp ogv}"
+
+# The same extensions as a set, for quick lookup
+declare -A VIDEO_EXTENSION_SET=()
+for extension in $VIDEO_EXTENSIONS; do
+  VIDEO_EXTENSION_SET[${extension,,}]=1
+done
+
+# FFmpeg arguments shared by every stream; only the input file and the
+# output URL differ. The global flags keep ffmpeg quiet, since progress
+# lines would flood the container log.
+FFMPEG_GLOBAL_ARGS=(-nostdin -hide_banner -nostats -loglevel warning)
+FFMPEG_INPUT_ARGS=(-re -stream_loop -1)
+case "$VIDEO_ENCODER" in
+  cpu)
+    FFMPEG_VIDEO_ARGS=(-c:v libx264 -preset veryfast)
+    ;;
+  nvenc)
+    FFMPEG_VIDEO_ARGS=(-c:v h264_nvenc -preset p4 -rc cbr -b:v 2M -maxrate 2.5M -bufsize 4M -g 50)
+    ;;
+  qsv)
+    FFMPEG_VIDEO_ARGS=(-c:v h264_qsv -preset veryfast -b:v 2M -g 50)
+    ;;
+  vaapi)
+    FFMPEG_GLOBAL_ARGS+=(-vaapi_device /dev/dri/renderD128)
+    FFMPEG_VIDEO_ARGS=(-vf format=nv12,hwupload -c:v h264_vaapi -b:v 2M -g 50)
+    ;;
+  *)
+    echo "Unknown VIDEO_ENCODER '$VIDEO_ENCODER', expected one of: cpu, nvenc, qsv, vaapi" >&2
+    exit 1
+    ;;
+esac
+FFMPEG_CODEC_ARGS=("${FFMPEG_VIDEO_ARGS[@]}" -c:a aac)
+
+if ! command -v ffmpeg >/dev/null; then
+  echo "ffmpeg not found in PATH" >&2
+  exit 1
+fi
+
+# Run each ffmpeg in its own session and process group, so stopping a
+# stream also stops anything ffmpeg spawned
+SETSID=()
+if command -v setsid >/dev/null; then
+  SETSID=(setsid)
+fi
+
+# RTSP paths each stream publishes to, newline-separated, keyed by video file
+declare -A STREAM_PATHS=()
+# Running streams, keyed by ffmpeg PID
+declare -A STREAM_FILES=()
+# Restarts so far, keyed by video file
+declare -A RESTART_COUNTS=()
+# When each stream was last (re)started, in $SECONDS, keyed by video file
+declare -A LAST_STARTS=()
+# Current restart backoff in seconds, keyed by video file
+declare -A BACKOFFS=()
+# Videos waiting for a free slot, in order
+PENDING=()
+
+# Stream a single file in the background, optionally after a delay,
+# and remember its PID
+start_stream() {
+  local file="$1"
+  local delay="${2:-0}"
+  local rtsp_paths=() urls=()
+  mapfile -t rtsp_paths <<< "${STREAM_PATHS[$file]}"
+  local rtsp_path
+  for rtsp_path in "${rtsp_paths[@]}"; do
+    urls+=("$RTSP_URL/$rtsp_path")
+  done
+
+  local cmd=(ffmpeg "${FFMPEG_GLOBAL_ARGS[@]}" "${FFMPEG_INPUT_ARGS[@]}" -i "$file")
+  if (( ${#urls[@]} == 1 )); then
+    cmd+=("${FFMPEG_CODEC_ARGS[@]}" -f rtsp "${urls[0]}")
+  else
+    # Encode once and let the tee muxer publish to every path. tee needs
+    # explicit maps; take one video and one audio stream, like a single
+    # output gets by default.
+    local tee_outputs
+    printf -v tee_outputs '|[f=rtsp]%s' "${urls[@]}"
+    cmd+=(-map 0:v:0 -map '0:a:0?' "${FFMPEG_CODEC_ARGS[@]}" -flags +global_header -f tee "${tee_outputs:1}")
+  fi
+
+  local targets
+  printf -v targets ', %s' "${urls[@]}"
+  if (( delay > 0 )); then
+    echo "Streaming $file to ${targets:2} in ${delay}s"
+  else
+    echo "Streaming $file to ${targets:2}"
+  fi
+  if [[ "$DEBUG" == 1 ]]; then
+    # Shell-quoted, so it can be copied and run as is
+    local command_line
+    printf -v command_line '%q ' "${cmd[@]}"
+    echo "Command: ${command_line% }"
+  fi
+  # The delay runs in the background so other streams are not held up.
+  # exec replaces the forked shell with ffmpeg, so each stream costs a
+  # single fork and the tracked PID is ffmpeg itself. setsid does not fork
+  # here because the subshell is never a process group leader.
+  (
+    if (( delay > 0 )); then
+      sleep "$delay"
+      # The server may have gone away while this stream was waiting; exit
+      # without starting ffmpeg and let the supervisor retry later
+      server_reachable || exit 1
+    fi
+    exec "${SETSID[@]}" "${cmd[@]}"
+  ) &
+  STREAM_FILES[$!]="$file"
+  LAST_STARTS[$file]=$(( SECONDS + delay ))
+}
+
+# Whether the RTSP server accepts TCP connections
+server_reachable() {
+  timeout 1 bash -c ": >/dev/tcp/$RTSP_HOST/$RTSP_PORT" 2>/dev/null
+}
+
+# Restart a stream whose ffmpeg exited, unless its file is gone. The
+# second argument says whether the RTSP server was reachable just now.
+restart_stream() {
+  local file="$1"
+  local reachable="$2"
+  # Check the cheap things before paying for an ffmpeg that is bound to fail
+  if [[ ! -r "$file" ]]; then
+    echo "Stream for $file exited and the file is no longer readable, giving up"
+    admit_pending
+    return
+  fi
+  if (( ! reachable )); then
+    echo "Stream for $file is down and $RTSP_HOST:$RTSP_PORT is unreachable, retrying in ${UNREACHABLE_DELAY}s"
+    start_stream "$file" "$UNREACHABLE_DELAY"
+    return
+  fi
+
+  if (( SECONDS - ${LAST_STARTS[$file]:-0} >= HEALTHY_RUNTIME )); then
+    RESTART_COUNTS[$file]=0
+    BACKOFFS[$file]=1
+  fi
+
+  local count=$(( ${RESTART_COUNTS[$file]:-0} + 1 ))
+  RESTART_COUNTS[$file]=$count
+  echo "Stream for $file exited, restarting (restart $count)"
+
+  # Back off exponentially, with jitter so streams that died together do
+  # not all come back at the same moment
+  local backoff=${BACKOFFS[$file]:-1}
+  local delay=$(( backoff + RANDOM % (backoff / 2 + 1) ))
+  backoff=$(( backoff * 2 ))
+  BACKOFFS[$file]=$(( backoff < MAX_RESTART_DELAY ? backoff : MAX_RESTART_DELAY ))
+  start_stream "$file" "$delay"
+}
+
+# Send a signal to a stream. Each ffmpeg leads its own process group, so
+# the whole group is signalled; a stream still waiting out its restart
+# delay has no group yet and is signalled directly.
+signal_stream() {
+  local signal="$1" pid="$2"
+  kill "-$signal" -- "-$pid" 2>/dev/null || kill "-$signal" "$pid" 2>/dev/null
+}
+
+# Stop every stream and exit. All streams are asked to stop at once and
+# share a single STOP_TIMEOUT, so shutdown takes as long as the slowest
+# stream rather than the sum of all of them.
+stop_streams() {
+  trap - TERM INT
+  local running=("${!STREAM_FILES[@]}")
+  echo "Stopping ${#running[@]} streams"
+  local pid
+  for pid in "${running[@]}"; do
+    signal_stream TERM "$pid"
+  done
+
+  # The timer is a child too, so `wait -n` also returns at the deadline
+  sleep "$STOP_TIMEOUT" &
+  local timer=$!
+  while (( ${#running[@]} > 0 )) && kill -0 "$timer" 2>/dev/null; do
+    wait -n
+    local alive=()
+    for pid in "${running[@]}"; do
+      if kill -0 "$pid" 2>/dev/null; then
+        alive+=("$pid")
+      fi
+    done
+    running=("${alive[@]}")
+  done
+  kill "$timer" 2>/dev/null
+
+  if (( ${#running[@]} > 0 )); then
+    echo "Killing ${#running[@]} streams that did not stop within ${STOP_TIMEOUT}s"
+    for pid in "${running[@]}"; do
+      signal_stream KILL "$pid"
+    done
+  fi
+  wait
+  exit 0
+}
+
+# Start pending videos while there are free slots, LAUNCH_BATCH per second
+admit_pending() {
+  local launched=0
+  while (( ${#PENDING[@]} > 0 && ${#STREAM_FILES[@]} < MAX_STREAMS )); do
+    start_stream "${PENDING[0]}" $(( launched / LAUNCH_BATCH ))
+    PENDING=("${PENDING[@]:1}")
+    launched=$(( launched + 1 ))
+  done
+}
+
+# Number of streams that fit into the memory available right now. Inside a
+# container /proc/meminfo shows the host's memory, so the container's cgroup
+# limit caps the estimate when one is set.
+memory_slots() {
+  local available_kb limit=""
+  available_kb=$(awk '/^MemAvailable:/ { print $2 }' /proc/meminfo 2>/dev/null)
+  if [[ -z "$available_kb" ]]; then
+    echo 0
+    return
+  fi
+  if [[ -r /sys/fs/cgroup/memory.max ]]; then
+    limit=$(< /sys/fs/cgroup/memory.max)  # cgroup v2, "max" when unlimited
+  elif [[ -r /sys/fs/cgroup/memory/memory.limit_in_bytes ]]; then
+    limit=$(< /sys/fs/cgroup/memory/memory.limit_in_bytes)  # cgroup v1
+  fi
+  if [[ "$limit" =~ ^[0-9]+$ ]] && (( limit / 1024 < available_kb )); then
+    available_kb=$(( limit / 1024 ))
+  fi
+  echo $(( available_kb / 1024 / STREAM_MEMORY_MB ))
+}
+
+# Collect every video up front so a bad entry is reported before anything
+# is launched. Anything else in the directory (e.g. Readme.md) is skipped.
+videos=()
 for file in "$VIDEOS_DIR"/*; do
-  if [[ -f "$file" ]]; then
-    FILENAME=$(basename "$file")
-    RTSP_PATH="${FILENAME%.*}"  # Use the filename as the unique path
-    echo "Streaming $file to $RTSP_URL/$RTSP_PATH"
-    ffmpeg -re -stream_loop -1 -i "$file" -c:v libx264 -preset veryfast -c:a aac -f rtsp "$RTSP_URL/$RTSP_PATH" &
+  if [[ ! -f "$file" ]]; then
+    if [[ -L "$file" ]]; then
+      # Absolute links made on the host point outside the mounted folder
+      echo "Skipping $file: broken symlink, use a link relative to the videos folder"
+    elif [[ -e "$file" ]]; then
+      echo "Skipping $file: not a regular file"
+    fi
+    continue
+  fi
+  extension="${file##*.}"
+  # Not `-v`: older bash expands its subscript a second time
+  if [[ -n "$extension" && -n "${VIDEO_EXTENSION_SET[${extension,,}]:-}" ]]; then
+    videos+=("$file")
+  else
+    echo "Skipping $file: not a video file"
+  fi
+done
+
+if (( ${#videos[@]} == 0 )); then
+  echo "No videos found in $VIDEOS_DIR" >&2
+  exit 1
+fi
+
+# Videos that are the same file (symlinks or hard links) share a single
+# ffmpeg that publishes to all of their paths, so it is decoded and
+# encoded only once
+declare -A FILES_BY_ID=()
+streams=()
+for file in "${videos[@]}"; do
+  filename="${file##*/}"
+  rtsp_path="${filename%.*}"  # Use the filename as the unique path
+  id=$(stat -L -c '%d:%i' "$file")
+  shared="${FILES_BY_ID[$id]:-}"
+  if [[ -n "$shared" ]]; then
+    echo "$file is the same video as $shared, sharing its stream"
+    STREAM_PATHS[$shared]+=$'\n'"$rtsp_path"
+  else
+    FILES_BY_ID[$id]="$file"
+    STREAM_PATHS[$file]="$rtsp_path"
+    streams+=("$file")
+  fi
+done
+
+if [[ -z "$MAX_STREAMS" ]]; then
+  MAX_STREAMS=$(memory_slots)
+  if (( MAX_STREAMS == 0 )); then
+    # Unknown or very little memory: run one stream rather than none
+    MAX_STREAMS=1
+  fi
+fi
+if [[ "$VIDEO_ENCODER" != cpu && -n "$MAX_ENCODER_SESSIONS" ]] && (( MAX_ENCODER_SESSIONS < MAX_STREAMS )); then
+  MAX_STREAMS=$MAX_ENCODER_SESSIONS
+fi
+if (( ${#streams[@]} > MAX_STREAMS )); then
+  echo "Running $MAX_STREAMS of ${#streams[@]} streams at once, the rest are queued"
+fi
+
+# Bash ignores SIGTERM as PID 1 in a container unless it is trapped
+trap stop_streams TERM INT
+
+# depends_on only orders container startup, so MediaMTX may not be
+# accepting connections yet
+until server_reachable; do
+  echo "Waiting for $RTSP_HOST:$RTSP_PORT"
+  sleep 1
+done
+
+# Queue every video and start as many as there are slots for. Each stream
+# is backgrounded right away; later batches sleep in the background, so
+# the supervisor is free as soon as the queue is handed out.
+PENDING=("${streams[@]}")
+admit_pending
+
+# Bash 5.1+ can report which child `wait -n` reaped, which saves probing
+# every stream after each exit
+WAIT_REPORTS_PID=0
+if (( BASH_VERSINFO[0] > 5 || (BASH_VERSINFO[0] == 5 && BASH_VERSINFO[1] >= 1) )); then
+  WAIT_REPORTS_PID=1
+fi
+
+# Sleep until one of the streams exits, then restart just that one.
+# `wait -n` blocks in the kernel until a child dies, so nothing wakes up
+# while every stream is healthy.
+while (( ${#STREAM_FILES[@]} > 0 )); do
+  exited_pid=""
+  if (( WAIT_REPORTS_PID )); then
+    wait -n -p exited_pid
+  else
+    wait -n
+  fi
+
+  if [[ -n "$exited_pid" ]]; then
+    exited=("$exited_pid")
+  else
+    exited=()
+    for pid in "${!STREAM_FILES[@]}"; do
+      if ! kill -0 "$pid" 2>/dev/null; then
+        exited+=("$pid")
+      fi
+    done
+  fi
+
+  exited_files=()
+  for pid in "${exited[@]}"; do
+    [[ -v STREAM_FILES[$pid] ]] || continue
+    exited_files+=("${STREAM_FILES[$pid]}")
+    unset 'STREAM_FILES[$pid]'
+  done
+  (( ${#exited_files[@]} > 0 )) || continue
+
+  # One probe covers every stream that exited together
+  reachable=1
+  if ! server_reachable; then
+    reachable=0
   fi
+  for file in "${exited_files[@]}"; do
+    restart_stream "$file" "$reachable"
+  done
 done
 
-# Wait indefinitely to keep the container running
-wait
+# Every stream's file is gone and none are queued. Exit with an error so
+# the container shows as failed rather than as a clean stop.
+echo "None of the videos can be streamed any more, exiting" >&2
+exit 1